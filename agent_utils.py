@@ -7,7 +7,7 @@ These functions handle the formatting and preparation of data for OpenAI API cal
 making it easy to customize system prompts and message formatting.
 
 Features:
-- System prompt formatting with project context
+- System prompt formatting with project context (cached)
 - OpenAI message format conversion
 - Clean separation of prompt logic from main processing
 - Easy customization for different use cases
@@ -27,9 +27,11 @@ Example:
     )
 """
 
+from functools import lru_cache
 from typing import List, Dict, Any
 
 
+@lru_cache(maxsize=1024)
 def format_system_prompt(system_message: str = None, project_system_message: str = None) -> str:
     """
     Format system prompt for OpenAI from agent's configuration.
@@ -61,6 +63,10 @@ def format_system_prompt(system_message: str = None, project_system_message: str
             "This project is about customer support for a tech company."
         )
         # Returns: "You are a helpful AI assistant.\n\nProject Context: This project is about customer support for a tech company."
+        
+    Note:
+        Results are cached per (system_message, project_system_message) pair,
+        since most requests of a project share the same prompts.
     """
     base_prompt = "You are a helpful AI assistant."
     
@@ -77,7 +83,7 @@ def format_messages_for_openai(
     system_prompt: str, 
     conversation_history: List[Dict[str, str]], 
     current_message: str
-) -> List[Dict[str, str]]:
+) -> List[Dict[str, Any]]:
     """
     Format conversation history and current message for OpenAI API.
     
@@ -96,7 +102,9 @@ def format_messages_for_openai(
     Returns:
         List of message dictionaries in OpenAI API format:
         - role: "system", "user", or "assistant"
-        - content: The message content
+        - content: The message content. For the current user message this is a
+                   list of content parts, so images or other parts can be appended
+                   in place.
         
     Example:
         # Format messages for OpenAI
@@ -114,9 +122,12 @@ def format_messages_for_openai(
         #     {"role": "system", "content": "You are a helpful assistant."},
         #     {"role": "user", "content": "Hello"},
         #     {"role": "assistant", "content": "Hi there!"},
-        #     {"role": "user", "content": "How are you today?"}
+        #     {"role": "user", "content": [{"type": "text", "text": "How are you today?"}]}
         # ]
         
+        # Attach an image to the current message
+        messages[-1]["content"].append({"type": "image_url", "image_url": {"url": image_url}})
+        
     Note:
         The timestamp field from conversation history is ignored as OpenAI
         doesn't use it. Only role and content are included in the API request.
@@ -131,7 +142,7 @@ def format_messages_for_openai(
             "content": msg["content"]
         })
     
-    # Add current user message
-    messages.append({"role": "user", "content": current_message})
+    # Add current user message as content parts so callers can append to it
+    messages.append({"role": "user", "content": [{"type": "text", "text": current_message}]})
     
     return messages
@@ -34,6 +34,7 @@ Serper API Integration:
 Architecture:
 - Main processing logic in process_message() function
 - Memory management via ConversationManager class
+- Streamed output batching via StreamBuffer class
 - Utility functions for OpenAI integration
 - Standard Lexia endpoints inherited from package
 
@@ -50,16 +51,42 @@ Author: Lexia Team
 License: MIT
 """
 
+import asyncio
+import atexit
+import base64
+import ipaddress
 import logging
-from openai import OpenAI
+import logging.handlers
 import os
-import requests
+import queue
+import random
+import re
+import socket
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set
 
-# Configure logging with informative format
+import httpx
+import orjson
+from cachetools import LRUCache, TTLCache
+from fastapi.responses import ORJSONResponse
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+# Configure logging with informative format. Records are handed to a background thread
+# through a queue, so writing log output never blocks the event loop.
+log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[logging.handlers.QueueHandler(log_queue)]
 )
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # Import AI agent components
@@ -73,12 +100,81 @@ from lexia import (
     create_lexia_app,
     add_standard_endpoints
 )
-from agent_utils import format_system_prompt, format_messages_for_openai
-from lexia.utils import set_env_variables, get_openai_api_key
+from agent_utils import format_system_prompt
+from streaming import CentrifugoPublisher, StreamBuffer
 
 # Initialize core services
 conversation_manager = ConversationManager(max_history=10)  # Keep last 10 messages per thread
 lexia = LexiaHandler()
+centrifugo = CentrifugoPublisher()
+
+# LexiaHandler points one shared Centrifugo client at the request's stream URL and token
+# before every send, so its calls must never overlap. A single worker thread runs them
+# one at a time, across all requests and event loops.
+lexia_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lexia")
+
+# Caps concurrent OpenAI generations per process to stay under the account's rate limits
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+
+# Images larger than this are passed to OpenAI by URL instead of inline
+MAX_INLINE_IMAGE_BYTES = 20 * 1024 * 1024
+
+# Specialized system prompt and instruction for food menu image analysis
+FOOD_MENU_SYSTEM_PROMPT = """You are a specialized food menu analyzer. Your ONLY job is to:
+
+1. Analyze the image to determine if it contains a food menu
+2. If it's a food menu: Extract ONLY the names of the food items/dishes
+3. If it's NOT a food menu: Respond with exactly "This is not a food menu. It's not my area of interest."
+
+Important rules:
+- Only respond to food menus
+- For food menus, extract ONLY food names (no descriptions, prices, or other details)
+- For non-food menus, use the exact phrase above
+- Be concise and direct
+- Do not provide any other information or explanations
+- Do not ask questions or engage in conversation
+- Focus solely on identifying food items from menus
+- Return food names in a simple list format"""
+
+FOOD_MENU_ANALYSIS_INSTRUCTION = "Please analyze this image and tell me if it's a food menu. If it is, extract the food names. If not, say it's not your area of interest."
+
+# Start of the model's reply when an uploaded image is not a food menu
+NOT_A_MENU_PREFIX = "This is not a food menu"
+
+# Fixed markdown blocks of the food menu results
+FOOD_RESULTS_HEADER = "# 🍽️ Food Menu Analysis Results\n\n"
+FOOD_RESULTS_FOOTER = "\n*All food items have been analyzed and photos searched via Serper API.*"
+FOOD_LIST_HEADER = "# 🍽️ Food Menu Items\n\n"
+NO_FOOD_NAMES_MESSAGE = FOOD_RESULTS_HEADER + "*No food names could be extracted from the menu.*"
+
+# Serper Images API endpoint used for food photo search
+SERPER_IMAGES_URL = "https://google.serper.dev/images"
+
+# Serper responses worth retrying, and the retry schedule (0.3 s, 0.6 s, plus up to 0.3 s
+# of random jitter so concurrent searches don't retry in lockstep)
+SERPER_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+SERPER_MAX_RETRIES = 2
+SERPER_BACKOFF_SECONDS = 0.3
+
+# Photo searches per menu; further food items are not searched
+MAX_PHOTO_SEARCHES = 10
+
+# Caps concurrent Serper requests per process across all menus being processed
+SERPER_MAX_CONCURRENCY = int(os.getenv("SERPER_MAX_CONCURRENCY", "20"))
+
+# Food name extraction: leading list markers ("- ", "• ", "* ", "1. "), the first
+# separator after the name (":", "-", "(", "["), filler words to drop and generic
+# words that are not food names
+LIST_MARKER_RE = re.compile(r"^(?:[-•*]|\d{1,2}\.)\s+")
+FOOD_NAME_SPLIT_RE = re.compile(r"[:\-(\[]")
+STOPWORDS = frozenset({'the', 'a', 'an', 'and', 'or', 'with', 'of', 'in', 'on', 'at', 'to', 'for'})
+NON_FOOD_NAMES = frozenset({'menu', 'food', 'dish', 'item', 'price', 'description', 's', 'es'})
+
+# Photo URLs found for normalized food names, reused across requests for a day. TTLCache
+# is not thread-safe and lexia dev mode runs each request on its own thread, so every
+# access holds food_photo_cache_lock.
+food_photo_cache: TTLCache = TTLCache(maxsize=4096, ttl=86400)
+food_photo_cache_lock = threading.Lock()
 
 # Create the FastAPI app using Lexia's web utilities
 app = create_lexia_app(
@@ -87,6 +183,377 @@ app = create_lexia_app(
     description="Production-ready AI agent starter kit with Lexia integration"
 )
 
+# Serialize JSON responses with orjson; applies to every route registered after this point.
+# FastAPI releases that serialize natively through Pydantic deprecate ORJSONResponse and
+# keep their default.
+if not getattr(ORJSONResponse, "__deprecated__", None):
+    app.router.default_response_class = ORJSONResponse
+
+
+class _OpenAIClientCache(LRUCache):
+    """
+    LRU cache of AsyncOpenAI clients that closes the clients it evicts.
+    
+    Every Lexia request brings its own OPENAI_API_KEY, so a worker can see more keys
+    than the cache holds. Evicted clients are closed in the background instead of
+    keeping their connection pools open until garbage collection. Must be written to
+    from within the running event loop that owns the clients.
+    """
+    
+    def __init__(self, maxsize: int):
+        super().__init__(maxsize=maxsize)
+        self._closing: Set[asyncio.Task] = set()
+    
+    def popitem(self):
+        key, client = super().popitem()
+        task = asyncio.get_running_loop().create_task(client.close())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+        return key, client
+    
+    async def aclose(self) -> None:
+        """
+        Close every cached client and wait for evicted clients to finish closing.
+        """
+        for client in self.values():
+            await client.close()
+        self.clear()
+        if self._closing:
+            await asyncio.gather(*self._closing)
+
+
+class _LoopResources:
+    """
+    Network clients and concurrency limits bound to one event loop.
+    
+    Pooled connections and asyncio semaphores belong to the event loop that uses them.
+    Production serves every request on uvicorn's loop, so there is one set per worker.
+    Lexia dev mode runs each request on a new loop in its own thread and closes that
+    loop afterwards, so each request gets its own set there and the caps do not apply
+    across dev-mode requests.
+    """
+    
+    def __init__(self):
+        # One OpenAI client per API key, keeping the 32 most recently used
+        self.openai_clients = _OpenAIClientCache(maxsize=32)
+        self.openai_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+        self.serper_semaphore = asyncio.Semaphore(SERPER_MAX_CONCURRENCY)
+        # Downloads uploaded images; every request and redirect is checked for a public host
+        self.http_client = httpx.AsyncClient(
+            timeout=10.0,
+            follow_redirects=True,
+            event_hooks={"request": [_reject_private_image_host]}
+        )
+        # Dedicated keep-alive client for Serper: every search goes to the same host, so pooled
+        # connections skip repeated TCP/TLS handshakes, and HTTP/2 multiplexes a menu's concurrent
+        # searches over a single connection. Connection failures are retried by the transport;
+        # rate limits and server errors are retried in _search_food_photo.
+        self.serper_client = httpx.AsyncClient(
+            headers={"Content-Type": "application/json"},
+            timeout=10.0,
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                retries=2,
+                limits=httpx.Limits(max_connections=16, max_keepalive_connections=16)
+            )
+        )
+    
+    async def aclose(self) -> None:
+        """
+        Close every client and its pooled connections.
+        """
+        await self.openai_clients.aclose()
+        await self.http_client.aclose()
+        await self.serper_client.aclose()
+
+
+_loop_resources: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _LoopResources]" = weakref.WeakKeyDictionary()
+_loop_resources_lock = threading.Lock()
+
+
+def _get_loop_resources() -> _LoopResources:
+    """
+    Return the network clients of the running event loop, creating them on first use.
+    """
+    loop = asyncio.get_running_loop()
+    with _loop_resources_lock:
+        resources = _loop_resources.get(loop)
+        if resources is None:
+            resources = _loop_resources[loop] = _LoopResources()
+    return resources
+
+
+async def _release_loop_resources() -> None:
+    """
+    Close and forget the running loop's network clients.
+    
+    Lexia dev mode closes a request's event loop as soon as the request finishes, so
+    its clients are released first rather than left with open connections.
+    """
+    with _loop_resources_lock:
+        resources = _loop_resources.pop(asyncio.get_running_loop(), None)
+    if resources is not None:
+        await resources.aclose()
+
+
+def _get_openai_client(api_key: str) -> "AsyncOpenAI":
+    """
+    Return the running loop's shared AsyncOpenAI client for the given API key.
+    
+    Clients are cached so that their HTTP connection pool is reused across
+    requests instead of being rebuilt for every message. The openai package is
+    imported on first use to keep worker start-up fast.
+    """
+    clients = _get_loop_resources().openai_clients
+    client = clients.get(api_key)
+    if client is None:
+        from openai import AsyncOpenAI
+        
+        client = clients[api_key] = AsyncOpenAI(
+            api_key=api_key,
+            http_client=httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+            )
+        )
+    return client
+
+
+async def _reject_private_image_host(request: httpx.Request) -> None:
+    """
+    Refuse image downloads from hosts that resolve to non-public addresses.
+    
+    file_url is supplied by the caller, so without this check the server could be made
+    to fetch private, loopback or link-local services. Lexia dev mode serves uploads
+    from localhost and is exempt.
+    
+    Raises:
+        httpx.ConnectError: If the host does not resolve or any of its addresses is not public
+    """
+    if lexia.dev_mode:
+        return
+    
+    host = request.url.host
+    try:
+        addresses = await asyncio.get_running_loop().getaddrinfo(host, request.url.port, type=socket.SOCK_STREAM)
+    except OSError as e:
+        raise httpx.ConnectError(f"Cannot resolve {host}: {e}", request=request)
+    if not all(ipaddress.ip_address(address[4][0]).is_global for address in addresses):
+        raise httpx.ConnectError(f"{host} is not a public host", request=request)
+
+
+async def _fetch_image_data_url(url: str) -> Optional[str]:
+    """
+    Download an image and encode it as a base64 data URL for OpenAI.
+    
+    Sending the image inline saves OpenAI from fetching it from the remote host
+    before it can start generating, which shortens time to first token.
+    
+    Args:
+        url: The remote image URL
+        
+    Returns:
+        The data URL, or None if the download fails, is not an image, exceeds
+        MAX_INLINE_IMAGE_BYTES, or is hosted on a non-public address. Callers
+        should fall back to the remote URL.
+    """
+    try:
+        async with _get_loop_resources().http_client.stream("GET", url) as response:
+            response.raise_for_status()
+            content_type = response.headers.get("content-type", "").split(";")[0].strip()
+            if not content_type.startswith("image/"):
+                logger.warning("⚠️ Not prefetching %s: unexpected content type '%s'", url, content_type)
+                return None
+            if int(response.headers.get("content-length") or 0) > MAX_INLINE_IMAGE_BYTES:
+                logger.warning("⚠️ Not prefetching %s: image is larger than %d bytes", url, MAX_INLINE_IMAGE_BYTES)
+                return None
+            
+            body = bytearray()
+            async for part in response.aiter_bytes():
+                body += part
+                if len(body) > MAX_INLINE_IMAGE_BYTES:
+                    logger.warning("⚠️ Not prefetching %s: image is larger than %d bytes", url, MAX_INLINE_IMAGE_BYTES)
+                    return None
+    except (httpx.HTTPError, ValueError) as e:
+        logger.warning("⚠️ Image prefetch failed for %s: %s", url, e)
+        return None
+    
+    return f"data:{content_type};base64,{base64.b64encode(body).decode('ascii')}"
+
+
+def _clean_food_name(line: str) -> Optional[str]:
+    """
+    Extract a food name from one line of the model's menu analysis.
+    
+    Removes list markers, anything after the first separator, numbers and
+    filler words.
+    
+    Args:
+        line: A single line of the OpenAI response
+        
+    Returns:
+        The cleaned food name, or None if the line does not contain a valid one
+    """
+    food_name = LIST_MARKER_RE.sub("", line.strip(), count=1)
+    food_name = FOOD_NAME_SPLIT_RE.split(food_name, maxsplit=1)[0]
+    food_name = ' '.join(
+        word for word in food_name.split()
+        if not word.isdigit() and word.lower() not in STOPWORDS
+    )
+    
+    # Only accept names that look like a real food item
+    if len(food_name) > 2 and food_name.lower() not in NON_FOOD_NAMES:
+        return food_name
+    return None
+
+
+def _format_food_item(result: Dict[str, Any]) -> str:
+    """
+    Format one food photo search result as markdown.
+    
+    The same text is streamed to the user and included in the complete response.
+    Found photos use markdown image syntax ![alt text](URL) for inline display in
+    Lexia, plus a clickable link to open the image in a new tab.
+    
+    Args:
+        result: A result from _search_food_photo, or a result with status
+               "no_key" when no Serper API key is configured
+        
+    Returns:
+        Markdown section for the food item
+    """
+    food_name = result["name"]
+    food_photo_url = result["url"]
+    status = result["status"]
+    
+    if food_photo_url:
+        return f"## 🍕 {food_name}\n\n📸 ![{food_name}]({food_photo_url})\n\n🔗 **[Click to open in new tab]({food_photo_url})**\n\n---\n\n"
+    if status == "no_key":
+        return f"## 🍕 {food_name}\n\n---\n\n"
+    if status == "no_photo":
+        status_msg = "*No photo found*"
+    elif status == "failed":
+        status_msg = f"*Search failed (Status: {result['status_code']})*"
+    elif status == "timeout":
+        status_msg = "*Search timeout*"
+    else:
+        status_msg = "*Search error*"
+    return f"## 🍕 {food_name}\n\n📸 {status_msg}\n\n---\n\n"
+
+
+def _food_cache_key(food_name: str) -> str:
+    """
+    Normalize a food name for photo cache lookups (case insensitive).
+    
+    Names from _clean_food_name already have their whitespace collapsed.
+    """
+    return food_name.lower()
+
+
+async def _search_food_photo(serper_api_key: str, food_name: str) -> Dict[str, Any]:
+    """
+    Search the Serper Images API for a photo of a food item.
+    
+    Photos found earlier for the same normalized name are served from
+    food_photo_cache without calling Serper. Errors are logged and reported
+    through the result status rather than raised, so searches for several
+    items can run concurrently without cancelling each other.
+    
+    Args:
+        serper_api_key: The SERPER_API_KEY from the request variables
+        food_name: The food name to search for
+        
+    Returns:
+        Dictionary with:
+        - name: The food name
+        - url: The photo URL, or None if no photo was found
+        - status: "ok", "no_photo", "failed", "timeout" or "error"
+        - status_code: The HTTP status code (only when status is "failed")
+    """
+    cache_key = _food_cache_key(food_name)
+    with food_photo_cache_lock:
+        cached_url = food_photo_cache.get(cache_key)
+    if cached_url:
+        logger.debug("💾 Photo cache hit for %s", food_name)
+        return {"name": food_name, "url": cached_url, "status": "ok"}
+    
+    resources = _get_loop_resources()
+    headers = {"X-API-KEY": serper_api_key}
+    search_data = orjson.dumps({
+        "q": f"{food_name} food photo",
+        "num": 1
+    })
+    
+    try:
+        for attempt in range(SERPER_MAX_RETRIES + 1):
+            async with resources.serper_semaphore:
+                response = await resources.serper_client.post(SERPER_IMAGES_URL, headers=headers, content=search_data)
+            if response.status_code not in SERPER_RETRY_STATUSES or attempt == SERPER_MAX_RETRIES:
+                break
+            # Back off without holding a concurrency slot
+            await asyncio.sleep(SERPER_BACKOFF_SECONDS * (2 ** attempt) + random.uniform(0, SERPER_BACKOFF_SECONDS))
+        
+        if response.status_code != 200:
+            logger.warning("❌ Serper API search failed for %s: %s", food_name, response.status_code)
+            return {"name": food_name, "url": None, "status": "failed", "status_code": response.status_code}
+        
+        search_results = orjson.loads(response.content)
+        
+        # Serper Images API returns results under 'images'
+        food_photo_url = ''
+        if 'images' in search_results and search_results['images']:
+            first_result = search_results['images'][0]
+            food_photo_url = first_result.get('imageUrl') or first_result.get('thumbnailUrl') or first_result.get('link') or ''
+    except httpx.TimeoutException:
+        logger.warning("⏰ Serper API timeout for %s", food_name)
+        return {"name": food_name, "url": None, "status": "timeout"}
+    except httpx.HTTPError as e:
+        logger.error("❌ Request error for %s: %s", food_name, e)
+        return {"name": food_name, "url": None, "status": "error"}
+    except Exception as e:
+        logger.error("❌ Unexpected error for %s: %s", food_name, e)
+        return {"name": food_name, "url": None, "status": "error"}
+    
+    if not food_photo_url:
+        logger.debug("⚠️ No photo found for %s", food_name)
+        return {"name": food_name, "url": None, "status": "no_photo"}
+    
+    with food_photo_cache_lock:
+        food_photo_cache[cache_key] = food_photo_url
+    return {"name": food_name, "url": food_photo_url, "status": "ok"}
+
+
+async def _lexia_call(method, *args) -> None:
+    """
+    Run a blocking LexiaHandler method without stalling the event loop.
+    
+    LexiaHandler publishes to Centrifugo with synchronous HTTP calls, so they are
+    executed on lexia_executor while other requests keep being served. Calls from
+    concurrent requests are queued rather than run in parallel, because each one
+    reconfigures the handler's shared Centrifugo client.
+    """
+    await asyncio.get_running_loop().run_in_executor(lexia_executor, method, *args)
+
+
+async def _stream_chunk(data: ChatMessage, content: str) -> None:
+    """
+    Stream a chunk of the response to Lexia.
+    
+    Chunks go straight to Centrifugo over the shared async connection pool when the
+    request carries stream credentials. Dev mode and requests without them fall back
+    to LexiaHandler.stream_chunk.
+    """
+    if lexia.dev_mode or not (data.stream_url and data.stream_token):
+        await _lexia_call(lexia.stream_chunk, data, content)
+        return
+    
+    await centrifugo.send_delta(
+        data.stream_url, data.stream_token,
+        data.channel, data.response_uuid, data.thread_id,
+        content
+    )
+
+
 async def process_message(data: ChatMessage) -> None:
     """
     Process incoming chat messages using OpenAI and send responses via Lexia.
@@ -94,7 +561,7 @@ async def process_message(data: ChatMessage) -> None:
     This is the core AI processing function that you can customize for your specific use case.
     The function handles:
     1. Message validation and logging
-    2. Environment variable setup
+    2. API key lookup from request variables
     3. OpenAI API communication
     4. File processing (images)
     5. Response streaming and completion
@@ -115,321 +582,267 @@ async def process_message(data: ChatMessage) -> None:
         - Customize error handling and logging
     """
     try:
-        # Log comprehensive request information for debugging
-        logger.info("=" * 80)
-        logger.info("📥 FULL REQUEST BODY RECEIVED:")
-        logger.info("=" * 80)
-        logger.info(f"Thread ID: {data.thread_id}")
-        logger.info(f"Message: {data.message}")
-        logger.info(f"Response UUID: {data.response_uuid}")
-        logger.info(f"Model: {data.model}")
-        logger.info(f"System Message: {data.system_message}")
-        logger.info(f"Project System Message: {data.project_system_message}")
-        logger.info(f"Variables: {data.variables}")
-        logger.info(f"Stream URL: {getattr(data, 'stream_url', 'Not provided')}")
-        logger.info(f"Stream Token: {getattr(data, 'stream_token', 'Not provided')}")
-        logger.info(f"Full data object: {data}")
-        logger.info("=" * 80)
+        # Log request details for debugging (skipped unless DEBUG is enabled). Variable
+        # values and the stream token are secrets, so only variable names are logged.
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "📥 REQUEST RECEIVED:\n"
+                "Thread ID: %s\nMessage: %s\nResponse UUID: %s\nModel: %s\n"
+                "System Message: %s\nProject System Message: %s\nVariables: %s\n"
+                "Stream URL: %s",
+                data.thread_id, data.message, data.response_uuid, data.model,
+                data.system_message, data.project_system_message,
+                [var.name for var in data.variables],
+                data.stream_url
+            )
         
         # Log key processing information
-        logger.info(f"🚀 Processing message for thread {data.thread_id}")
-        logger.info(f"📝 Message: {data.message[:100]}...")
-        logger.info(f"🔑 Response UUID: {data.response_uuid}")
+        logger.info("🚀 Processing message for thread %s", data.thread_id)
+        logger.debug("📝 Message: %.100s...", data.message)
+        logger.debug("🔑 Response UUID: %s", data.response_uuid)
         
-        # Set environment variables and get OpenAI API key
-        set_env_variables(data.variables)
-        openai_api_key = get_openai_api_key(data.variables)
+        # Index the request variables once; they are read directly instead of being copied
+        # into os.environ, which is shared by every concurrent request
+        variables = {var.name: var.value for var in data.variables}
+        openai_api_key = variables.get("OPENAI_API_KEY")
         if not openai_api_key:
             error_msg = "OpenAI API key not found in variables"
             logger.error(error_msg)
-            lexia.send_error(data, error_msg)
+            await _lexia_call(lexia.send_error, data, error_msg)
             return
         
-        # Initialize OpenAI client and conversation management
-        client = OpenAI(api_key=openai_api_key)
-        conversation_manager.add_message(data.thread_id, "user", data.message)
-        thread_history = conversation_manager.get_history(data.thread_id)
+        # Start downloading an uploaded image right away so it overlaps with prompt preparation
+        is_image_message = data.file_type == 'image' and bool(data.file_url)
+        image_task = asyncio.create_task(_fetch_image_data_url(data.file_url)) if is_image_message else None
+        
+        # Initialize OpenAI client
+        client = _get_openai_client(openai_api_key)
         
         # Process image files if present
-        if hasattr(data, 'file_type') and data.file_type == 'image' and hasattr(data, 'file_url') and data.file_url:
-            logger.info(f"🖼️ Image detected: {data.file_url}")
+        if is_image_message:
+            logger.debug("🖼️ Image detected: %s", data.file_url)
+            logger.debug("🍽️ Food menu analysis mode activated")
             
-            # Create specialized system prompt for food menu analysis
-            food_menu_system_prompt = """You are a specialized food menu analyzer. Your ONLY job is to:
-
-1. Analyze the image to determine if it contains a food menu
-2. If it's a food menu: Extract ONLY the names of the food items/dishes
-3. If it's NOT a food menu: Respond with exactly "This is not a food menu. It's not my area of interest."
-
-Important rules:
-- Only respond to food menus
-- For food menus, extract ONLY food names (no descriptions, prices, or other details)
-- For non-food menus, use the exact phrase above
-- Be concise and direct
-- Do not provide any other information or explanations
-- Do not ask questions or engage in conversation
-- Focus solely on identifying food items from menus
-- Return food names in a simple list format"""
-
-            logger.info("🍽️ Food menu analysis mode activated")
-            logger.info("📋 System prompt updated for specialized food menu analysis")
-            
-            # Format messages for OpenAI with food menu analysis
-            messages = [{"role": "system", "content": food_menu_system_prompt}]
-            
-            # Add conversation history (excluding timestamp)
-            for msg in thread_history:
-                messages.append({
-                    "role": msg["role"],
-                    "content": msg["content"]
-                })
+            # Store the user message and format the thread for food menu analysis
+            messages = conversation_manager.build_openai_messages(
+                data.thread_id, FOOD_MENU_SYSTEM_PROMPT, data.message
+            )
             
-            # Add current user message with image
-            messages.append({
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": "Please analyze this image and tell me if it's a food menu. If it is, extract the food names. If not, say it's not your area of interest."},
-                    {"type": "image_url", "image_url": {"url": data.file_url}}
-                ]
-            })
+            # Attach the analysis instruction and the image to the current user message,
+            # inlining the image when the prefetch succeeded
+            image_url = await image_task or data.file_url
+            messages[-1]["content"].extend([
+                {"type": "text", "text": FOOD_MENU_ANALYSIS_INSTRUCTION},
+                {"type": "image_url", "image_url": {"url": image_url}}
+            ])
             
-            logger.info("🖼️ Image added to OpenAI request for food menu analysis")
-            logger.info("🍽️ Using specialized food menu analysis system prompt")
+            logger.debug("🖼️ Image added to OpenAI request for food menu analysis")
             
             # Set system_prompt for logging
-            system_prompt = food_menu_system_prompt
+            system_prompt = FOOD_MENU_SYSTEM_PROMPT
         else:
             # For non-image messages, use the original system prompt and message formatting
             system_prompt = format_system_prompt(data.system_message, data.project_system_message)
-            messages = format_messages_for_openai(system_prompt, thread_history, data.message)
+            messages = conversation_manager.build_openai_messages(data.thread_id, system_prompt, data.message)
         
         # Log OpenAI request details
-        logger.info(f"🤖 Sending to OpenAI model: {data.model}")
-        logger.info(f"💬 System prompt: {system_prompt[:100]}...")
-        logger.info(f"📤 Messages being sent to OpenAI: {messages}")
-        
-        # Stream response from OpenAI
-        stream = client.chat.completions.create(
-            model=data.model,
-            messages=messages,
-            max_tokens=1000,
-            temperature=0.7,
-            stream=True
-        )
+        logger.debug("🤖 Sending to OpenAI model: %s", data.model)
+        logger.debug("💬 System prompt: %.100s...", system_prompt)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("📤 Messages being sent to OpenAI: %s", messages)
         
         # Process streaming response
-        full_response = ""
-        usage_info = None
+        response_parts: List[str] = []
+        last_chunk = None
         
-        logger.info("📡 Streaming response from OpenAI...")
+        # Coalesce deltas so Centrifugo receives a few larger chunks instead of one per token
+        stream_buffer = StreamBuffer(lambda text: _stream_chunk(data, text))
         
-        # Suppress streaming to Lexia for image messages to avoid partial lists without URLs
-        is_image_message = hasattr(data, 'file_type') and data.file_type == 'image' and hasattr(data, 'file_url') and data.file_url
-
-        for chunk in stream:
-            # Handle content chunks
-            if chunk.choices[0].delta.content:
-                content = chunk.choices[0].delta.content
-                full_response += content
-                # Stream chunk to Lexia via Centrifugo
-                if not is_image_message:
-                    lexia.stream_chunk(data, content)
-            
-            # Capture usage information from the last chunk
-            if chunk.usage:
-                usage_info = chunk.usage
-                logger.info(f"📊 Usage info captured: {usage_info}")
+        # Image messages are held back to avoid streaming partial lists without URLs, until
+        # the start of the reply shows whether the model declined the image. A decline is
+        # then streamed live and skips the food name extraction and photo search.
+        stream_live = not is_image_message
+        awaiting_menu_check = is_image_message
+        is_rejection = False
         
-        logger.info(f"✅ OpenAI response complete. Length: {len(full_response)} characters")
- 
-        # Track streamed results to include URLs in the final completion
-        collected_food_results = None
+        # Food names are extracted line by line while the menu is still generating, and each
+        # photo search starts as soon as its line is complete. Dishes listed more than once
+        # keep their first spelling and are searched only once.
+        serper_api_key = variables.get("SERPER_API_KEY") if is_image_message else None
+        line_parts: List[str] = []
+        food_names: List[str] = []
+        seen_food_names = set()
+        search_tasks: Dict["asyncio.Task[Dict[str, Any]]", int] = {}
         
-        # Process food menu response and search for food photos if applicable
-        if hasattr(data, 'file_type') and data.file_type == 'image' and hasattr(data, 'file_url') and data.file_url:
-            if "This is not a food menu" not in full_response:
-                logger.info("🍽️ Food menu detected, searching for food photos...")
+        def collect_food_name(line: str) -> None:
+            food_name = _clean_food_name(line)
+            logger.debug("📝 Line %r -> %r", line, food_name)
+            if not food_name:
+                return
+            food_key = _food_cache_key(food_name)
+            if food_key in seen_food_names:
+                return
+            seen_food_names.add(food_key)
+            food_names.append(food_name)
+            if serper_api_key and len(search_tasks) < MAX_PHOTO_SEARCHES:
+                search_tasks[asyncio.create_task(_search_food_photo(serper_api_key, food_name))] = len(search_tasks)
+        
+        # Searches and buffered chunks left over after an error are stopped, so nothing
+        # is published after the error and no Serper quota is spent on discarded results
+        try:
+            # Stream response from OpenAI, holding a concurrency slot for the whole generation
+            async with _get_loop_resources().openai_semaphore:
+                stream = await client.chat.completions.create(
+                    model=data.model,
+                    messages=messages,
+                    max_tokens=1000,
+                    temperature=0.7,
+                    stream=True,
+                    stream_options={"include_usage": True}
+                )
                 
-                # Extract food names from the response
-                food_names = []
-                lines = full_response.strip().split('\n')
-                logger.info(f"🔍 Processing {len(lines)} lines from OpenAI response")
+                logger.debug("📡 Streaming response from OpenAI...")
                 
-                for line in lines:
-                    line = line.strip()
-                    if line:  # Process any non-empty line
-                        logger.info(f"📝 Processing line: '{line}'")
-                        
-                        # Remove list markers and clean up the line
-                        food_name = line
-                        # Remove common list markers
-                        for marker in ['- ', '• ', '* ', '1. ', '2. ', '3. ', '4. ', '5. ', '6. ', '7. ', '8. ', '9. ', '10. ']:
-                            if food_name.startswith(marker):
-                                food_name = food_name[len(marker):]
-                                logger.info(f"  🏷️ Removed marker '{marker}', result: '{food_name}'")
-                                break
+                async for chunk in stream:
+                    last_chunk = chunk
+                    # Handle content chunks (the final usage chunk has no choices)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        content = chunk.choices[0].delta.content
+                        response_parts.append(content)
+                        if is_image_message:
+                            line_parts.append(content)
                         
-                        # Clean up the food name by removing common suffixes and prefixes
-                        food_name = food_name.split(':')[0].split('-')[0].split('(')[0].split('[')[0].strip()
-                        logger.info(f"  🧹 After cleanup: '{food_name}'")
+                        if awaiting_menu_check:
+                            head = "".join(response_parts).lstrip()
+                            if len(head) >= len(NOT_A_MENU_PREFIX) or not NOT_A_MENU_PREFIX.startswith(head):
+                                awaiting_menu_check = False
+                                is_rejection = head.startswith(NOT_A_MENU_PREFIX)
+                                if is_rejection:
+                                    logger.debug("🚫 Not a food menu, streaming the reply live")
+                                    stream_live = True
+                                    content = "".join(response_parts)
                         
-                        # Remove numbers and common words
-                        food_name = ' '.join([word for word in food_name.split() if not word.isdigit() and word.lower() not in ['the', 'a', 'an', 'and', 'or', 'with', 'of', 'in', 'on', 'at', 'to', 'for']])
-                        logger.info(f"  🔤 After word filtering: '{food_name}'")
-                        
-                        # Only add if it's a valid food name
-                        if food_name and len(food_name) > 2 and not food_name.lower() in ['menu', 'food', 'dish', 'item', 'price', 'description', 's', 'es']:
-                            food_names.append(food_name)
-                            logger.info(f"  ✅ Added food name: '{food_name}'")
-                        else:
-                            logger.info(f"  ❌ Rejected: '{food_name}' (length: {len(food_name) if food_name else 0})")
+                        # Stream chunk to Lexia via Centrifugo
+                        if stream_live:
+                            stream_buffer.write(content)
+                        elif not awaiting_menu_check and "\n" in content:
+                            *lines, tail = "".join(line_parts).split("\n")
+                            line_parts = [tail]
+                            for line in lines:
+                                collect_food_name(line)
+            
+            # With include_usage, only the final chunk carries usage information
+            usage_info = last_chunk.usage if last_chunk is not None else None
+            logger.debug("📊 Usage info captured: %s", usage_info)
+            
+            # Deliver any buffered text before further chunks or the completion signal
+            await stream_buffer.close()
+            full_response = "".join(response_parts)
+            
+            logger.debug("✅ OpenAI response complete. Length: %d characters", len(full_response))
+     
+            # Process food menu response and search for food photos if applicable (declined
+            # images were already streamed live above). Each markdown part is streamed once.
+            # Photo results stream in the order their searches finish, while the complete
+            # response sent to Lexia lists them in menu order.
+            if is_image_message and not is_rejection:
+                logger.debug("🍽️ Food menu detected, searching for food photos...")
+                
+                # Extract food names from any lines not yet scanned during the stream
+                for line in "".join(line_parts).split("\n"):
+                    collect_food_name(line)
                 
-                logger.info(f"🍕 Extracted food names: {food_names}")
+                logger.debug("🍕 Extracted food names: %s", food_names)
                 
                 # Search for food photos using Serper API
                 if food_names:
-                    collected_food_results = []
-                    # Get Serper API key from variables
-                    serper_api_key = None
-                    for var in data.variables:
-                        if var.name == "SERPER_API_KEY":
-                            serper_api_key = var.value
-                            break
-                    
                     if serper_api_key:
-                        logger.info("🔍 Using Serper API to search for food photos...")
+                        logger.debug("🔍 Using Serper API to search for food photos...")
+                        
+                        # Stream header first, then each food item with its photo as soon as it's found
+                        markdown_parts = [FOOD_RESULTS_HEADER]
+                        await _stream_chunk(data, markdown_parts[-1])
                         
-                        # Stream header first
-                        # Stream each food item with photo URL as soon as it's found
-                        header_message = "# 🍽️ Food Menu Analysis Results\n\n"
-                        lexia.stream_chunk(data, header_message)
+                        # Searches started during the stream run concurrently; stream each item the
+                        # moment its search finishes, while the complete response keeps the menu order
+                        item_parts = [""] * len(search_tasks)
                         
-                        for food_name in food_names[:10]:  # Limit to first 10 items
-                            try:
-                                # Search for food photos using Serper Images API
-                                search_url = "https://google.serper.dev/images"
-                                headers = {
-                                    "X-API-KEY": serper_api_key,
-                                    "Content-Type": "application/json"
-                                }
-                                search_data = {
-                                    "q": f"{food_name} food photo",
-                                    "num": 1
-                                }
-                                
-                                response = requests.post(search_url, headers=headers, json=search_data, timeout=10)
-                                
-                                if response.status_code == 200:
-                                    search_results = response.json()
-                                    # Serper Images API returns results under 'images'
-                                    food_photo_url = ''
-                                    if 'images' in search_results and search_results['images']:
-                                        first_result = search_results['images'][0]
-                                        food_photo_url = first_result.get('imageUrl') or first_result.get('thumbnailUrl') or first_result.get('link') or ''
-                                    
-                                    # Stream this food item immediately with markdown formatting
-                                    # Uses markdown image syntax ![alt text](URL) for inline image display in Lexia
-                                    # Also includes clickable link to open image in new tab
-                                    # This provides both visual preview and clickable functionality
-                                    if food_photo_url:
-                                        food_item_message = f"## 🍕 {food_name}\n\n📸 ![{food_name}]({food_photo_url})\n\n🔗 **[Click to open in new tab]({food_photo_url})**\n\n---\n\n"
-                                        lexia.stream_chunk(data, food_item_message)
-                                        collected_food_results.append({"name": food_name, "url": food_photo_url, "status": "ok"})
-                                        logger.info(f"✅ Found and streamed photo for {food_name}: {food_photo_url}")
-                                    else:
-                                        food_item_message = f"## 🍕 {food_name}\n\n📸 *No photo found*\n\n---\n\n"
-                                        lexia.stream_chunk(data, food_item_message)
-                                        collected_food_results.append({"name": food_name, "url": None, "status": "no_photo"})
-                                        logger.info(f"⚠️ No photo found for {food_name}")
-                                else:
-                                    food_item_message = f"## 🍕 {food_name}\n\n📸 *Search failed (Status: {response.status_code})*\n\n---\n\n"
-                                    lexia.stream_chunk(data, food_item_message)
-                                    collected_food_results.append({"name": food_name, "url": None, "status": "failed"})
-                                    logger.warning(f"❌ Serper API search failed for {food_name}: {response.status_code}")
-                                    
-                            except requests.exceptions.Timeout:
-                                food_item_message = f"## 🍕 {food_name}\n\n📸 *Search timeout*\n\n---\n\n"
-                                lexia.stream_chunk(data, food_item_message)
-                                collected_food_results.append({"name": food_name, "url": None, "status": "timeout"})
-                                logger.warning(f"⏰ Serper API timeout for {food_name}")
-                            except requests.exceptions.RequestException as e:
-                                food_item_message = f"## 🍕 {food_name}\n\n📸 *Search error*\n\n---\n\n"
-                                lexia.stream_chunk(data, food_item_message)
-                                collected_food_results.append({"name": food_name, "url": None, "status": "error"})
-                                logger.error(f"❌ Request error for {food_name}: {str(e)}")
-                            except Exception as e:
-                                food_item_message = f"## 🍕 {food_name}\n\n📸 *Search error*\n\n---\n\n"
-                                lexia.stream_chunk(data, food_item_message)
-                                collected_food_results.append({"name": food_name, "url": None, "status": "error"})
-                                logger.error(f"❌ Unexpected error for {food_name}: {str(e)}")
+                        pending = set(search_tasks)
+                        while pending:
+                            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                            for search_task in done:
+                                index = search_tasks[search_task]
+                                item_parts[index] = _format_food_item(search_task.result())
+                                await _stream_chunk(data, item_parts[index])
                         
-                        # No need to build enhanced_response since we're streaming everything
-                        # Just set full_response to indicate completion
-                        full_response = "🍽️ Food menu analysis completed with photo search results."
-                        logger.info("🎉 All food items streamed with photo search results")
+                        markdown_parts.extend(item_parts)
+                        
+                        markdown_parts.append(FOOD_RESULTS_FOOTER)
+                        logger.debug("🎉 All food items streamed with photo search results")
                     else:
                         logger.warning("⚠️ SERPER_API_KEY not found in variables, sending basic food list")
                         # Stream basic food list with markdown formatting
-                        header_message = "# 🍽️ Food Menu Items\n\n"
-                        lexia.stream_chunk(data, header_message)
+                        markdown_parts = [FOOD_LIST_HEADER]
+                        await _stream_chunk(data, markdown_parts[-1])
                         
                         for food_name in food_names:
-                            food_item_message = f"## 🍕 {food_name}\n\n---\n\n"
-                            lexia.stream_chunk(data, food_item_message)
-                        collected_food_results = [{"name": n, "url": None, "status": "no_key"} for n in food_names]
-                        
-                        full_response = "🍽️ Basic food menu list completed."
-                else:
-                    logger.info("⚠️ No food names extracted from response")
-            else:
-                # Not a food menu: stream the exact message immediately
-                clean_msg = full_response.strip()
-                if clean_msg:
-                    lexia.stream_chunk(data, clean_msg + "\n")
-                    logger.info("🚫 Not a food menu message streamed")
-        
-        # Build complete response content for Lexia completion
-        # Lexia needs complete content for memory storage and completion signal
-        if hasattr(data, 'file_type') and data.file_type == 'image' and hasattr(data, 'file_url') and data.file_url:
-            if "This is not a food menu" not in full_response:
-                # Build the complete markdown response including URLs where available
-                complete_content = "# 🍽️ Food Menu Analysis Results\n\n"
-                if collected_food_results:
-                    for item in collected_food_results:
-                        name = item.get("name")
-                        url = item.get("url")
-                        status = item.get("status")
-                        complete_content += f"## 🍕 {name}\n\n"
-                        if url:
-                            complete_content += f"📸 ![{name}]({url})\n\n🔗 **[Click to open in new tab]({url})**\n\n---\n\n"
-                        else:
-                            # Map statuses to messages
-                            status_msg = "*No photo found*" if status in ["no_photo", "no_key"] else "*Search error*"
-                            if status == "failed":
-                                status_msg = "*Search failed*"
-                            if status == "timeout":
-                                status_msg = "*Search timeout*"
-                            complete_content += f"📸 {status_msg}\n\n---\n\n"
-                    complete_content += "\n*All food items have been analyzed and photos searched via Serper API.*"
+                            markdown_parts.append(_format_food_item({"name": food_name, "url": None, "status": "no_key"}))
+                            await _stream_chunk(data, markdown_parts[-1])
                 else:
-                    complete_content += "*No food names could be extracted from the menu.*"
-                full_response = complete_content
-                logger.info("📋 Complete response content built for Lexia completion (with URLs)")
+                    logger.debug("⚠️ No food names extracted from response")
+                    markdown_parts = [NO_FOOD_NAMES_MESSAGE]
+                    await _stream_chunk(data, markdown_parts[-1])
+                
+                # Lexia needs the complete content for memory storage and the completion signal
+                full_response = "".join(markdown_parts)
+        finally:
+            for search_task in search_tasks:
+                search_task.cancel()
+            stream_buffer.cancel()
         
-        # Store response in conversation memory
+        # Store the response in conversation memory and send it to Lexia
         conversation_manager.add_message(data.thread_id, "assistant", full_response)
+        logger.debug("📤 Sending complete response to Lexia...")
+        await _lexia_call(lexia.complete_response, data, full_response, usage_info)
         
-        # Send complete response to Lexia
-        logger.info("📤 Sending complete response to Lexia...")
-        lexia.complete_response(data, full_response, usage_info)
-        
-        logger.info(f"🎉 Message processing completed successfully for thread {data.thread_id}")
+        logger.info(
+            "🎉 Message processing completed for thread %s (%d characters, usage: %s)",
+            data.thread_id, len(full_response), usage_info
+        )
             
     except Exception as e:
         error_msg = f"Error processing message: {str(e)}"
         logger.error(error_msg, exc_info=True)
-        lexia.send_error(data, error_msg)
+        await _lexia_call(lexia.send_error, data, error_msg)
+    finally:
+        # Each dev-mode request runs on its own event loop, closed once this returns
+        if lexia.dev_mode:
+            await _release_loop_resources()
+
+
+async def _close_clients() -> None:
+    """
+    Close the shared network clients and their pooled connections on shutdown.
+    """
+    await centrifugo.aclose()
+    await _release_loop_resources()
+
 
+# Close the clients when the app's lifespan ends. Wrapping the router's lifespan works on
+# every Starlette release, while shutdown event handlers were removed in Starlette 1.0.
+_app_lifespan = app.router.lifespan_context
+
+
+@asynccontextmanager
+async def _lifespan(app):
+    async with _app_lifespan(app) as state:
+        try:
+            yield state
+        finally:
+            await _close_clients()
+
+
+app.router.lifespan_context = _lifespan
 
 # Add standard Lexia endpoints including the inherited send_message endpoint
 # This provides all the standard functionality without additional code
@@ -443,34 +856,47 @@ add_standard_endpoints(
 if __name__ == "__main__":
     import uvicorn
     
-    print("🚀 Starting Lexia AI Agent Starter Kit - Food Menu Analyzer with Photo Search...")
-    print("=" * 60)
-    print("📖 API Documentation: http://localhost:8000/docs")
-    print("🔍 Health Check: http://localhost:8000/api/v1/health")
-    print("💬 Chat Endpoint: http://localhost:8000/api/v1/send_message")
-    print("=" * 60)
-    print("\n✨ This starter kit demonstrates:")
-    print("   - Clean integration with Lexia package")
-    print("   - Inherited endpoints for common functionality")
-    print("   - Specialized food menu image analysis")
-    print("   - Internet photo search using Serper API")
-    print("   - Conversation memory management")
-    print("   - File processing (images)")
-    print("   - Proper data structure for Lexia communication")
-    print("   - Comprehensive error handling and logging")
-    print("\n🍽️ Food Menu Analysis Features:")
-    print("   - Automatically detects food menu images")
-    print("   - Extracts food names from menus")
-    print("   - Searches internet for food photos")
-    print("   - Returns clickable photo URLs")
-    print("   - Declines non-food menu images")
-    print("   - Focused and concise responses")
-    print("\n🔍 Serper API Integration:")
-    print("   - Internet photo search for food items")
-    print("   - Uses SERPER_API_KEY from Lexia variables")
-    print("   - Enhanced responses with photo links")
-    print("\n🔧 Customize the process_message() function to add your AI logic!")
-    print("=" * 60)
-    
-    # Start the FastAPI server
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    print("\n".join([
+        "🚀 Starting Lexia AI Agent Starter Kit - Food Menu Analyzer with Photo Search...",
+        "=" * 60,
+        "📖 API Documentation: http://localhost:8000/docs",
+        "🔍 Health Check: http://localhost:8000/api/v1/health",
+        "💬 Chat Endpoint: http://localhost:8000/api/v1/send_message",
+        "=" * 60,
+        "\n✨ This starter kit demonstrates:",
+        "   - Clean integration with Lexia package",
+        "   - Inherited endpoints for common functionality",
+        "   - Specialized food menu image analysis",
+        "   - Internet photo search using Serper API",
+        "   - Conversation memory management",
+        "   - File processing (images)",
+        "   - Proper data structure for Lexia communication",
+        "   - Comprehensive error handling and logging",
+        "\n🍽️ Food Menu Analysis Features:",
+        "   - Automatically detects food menu images",
+        "   - Extracts food names from menus",
+        "   - Searches internet for food photos",
+        "   - Returns clickable photo URLs",
+        "   - Declines non-food menu images",
+        "   - Focused and concise responses",
+        "\n🔍 Serper API Integration:",
+        "   - Internet photo search for food items",
+        "   - Uses SERPER_API_KEY from Lexia variables",
+        "   - Enhanced responses with photo links",
+        "\n🔧 Customize the process_message() function to add your AI logic!",
+        "=" * 60,
+    ]))
+    
+    # Start the FastAPI server on uvloop with the httptools parser, with a deeper accept
+    # queue for connection bursts. Conversation memory is kept in-process, so only raise
+    # WEB_CONCURRENCY with sticky routing or shared storage.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        backlog=int(os.getenv("SERVER_BACKLOG", "2048")),
+        log_level="info"
+    )
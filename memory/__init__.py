@@ -24,6 +24,9 @@ Usage:
     
     # Get conversation history
     history = manager.get_history("thread_123")
+    
+    # Store a user message and format the thread for OpenAI
+    messages = manager.build_openai_messages("thread_123", "You are helpful.", "Thanks!")
 """
 
 from .conversation_manager import ConversationManager
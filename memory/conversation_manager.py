@@ -31,8 +31,9 @@ Example:
     thread_count = manager.get_thread_count()
 """
 
-from typing import List, Dict, Any
-from collections import defaultdict
+import threading
+from typing import List, Dict, Any, Deque
+from collections import defaultdict, deque
 
 
 class ConversationManager:
@@ -46,7 +47,7 @@ class ConversationManager:
     
     Attributes:
         max_history (int): Maximum number of messages to keep per thread
-        conversations (Dict): Internal storage of conversation data
+        conversations (Dict): Internal storage of conversation data (one bounded deque per thread)
         
     Example:
         # Create manager with 15 message history limit
@@ -59,6 +60,13 @@ class ConversationManager:
         # Retrieve conversation history
         history = manager.get_history("thread_1")
         print(f"Thread has {len(history)} messages")
+        
+    Note:
+        All methods are synchronous and never await, so coroutines sharing one event
+        loop cannot interleave inside a call. Lexia dev mode runs each request on its
+        own OS thread, so the store is guarded by a single threading.Lock, which is
+        uncontended on a single loop. A persistent backend that performs I/O should
+        add per-thread locking (e.g. striped asyncio locks) instead of one global lock.
     """
     
     def __init__(self, max_history: int = 10):
@@ -70,7 +78,11 @@ class ConversationManager:
                         Older messages are automatically removed when this limit is exceeded.
         """
         self.max_history = max_history
-        self.conversations: Dict[str, List[Dict[str, str]]] = defaultdict(list)
+        # Bounded deques drop the oldest message automatically in O(1)
+        self.conversations: Dict[str, Deque[Dict[str, str]]] = defaultdict(
+            lambda: deque(maxlen=self.max_history)
+        )
+        self._lock = threading.Lock()
     
     def add_message(self, thread_id: str, role: str, content: str) -> None:
         """
@@ -96,11 +108,9 @@ class ConversationManager:
             'timestamp': self._get_timestamp()
         }
         
-        self.conversations[thread_id].append(message)
-        
-        # Maintain max history limit by removing oldest messages
-        if len(self.conversations[thread_id]) > self.max_history:
-            self.conversations[thread_id].pop(0)
+        # The thread's deque discards its oldest message once max_history is reached
+        with self._lock:
+            self.conversations[thread_id].append(message)
     
     def get_history(self, thread_id: str) -> List[Dict[str, str]]:
         """
@@ -120,7 +130,59 @@ class ConversationManager:
             for msg in history:
                 print(f"{msg['role']}: {msg['content']}")
         """
-        return self.conversations.get(thread_id, [])
+        with self._lock:
+            history = self.conversations.get(thread_id)
+            return list(history) if history is not None else []
+    
+    def build_openai_messages(
+        self,
+        thread_id: str,
+        system_prompt: str,
+        user_message: str
+    ) -> List[Dict[str, Any]]:
+        """
+        Add a user message to a thread and format the thread for OpenAI in one pass.
+        
+        The new message is stored like any other, then the system
+        prompt and the whole thread are converted to OpenAI's chat format without
+        copying the history first. The user message appears exactly once, as the
+        last entry.
+        
+        Args:
+            thread_id: Unique identifier for the conversation thread
+            system_prompt: The formatted system prompt defining AI behavior
+            user_message: The current user message to store and send
+            
+        Returns:
+            List of message dictionaries in OpenAI API format. Timestamps are
+            dropped, and the current user message's content is a list of content
+            parts so images can be appended in place.
+            
+        Example:
+            messages = manager.build_openai_messages("user_123", "You are helpful.", "Hi!")
+            # [
+            #     {"role": "system", "content": "You are helpful."},
+            #     ...previous messages...,
+            #     {"role": "user", "content": [{"type": "text", "text": "Hi!"}]}
+            # ]
+        """
+        message = {
+            'role': "user",
+            'content': user_message,
+            'timestamp': self._get_timestamp()
+        }
+        
+        # Store and read under one lock so the new message is always the last entry
+        messages: List[Dict[str, Any]] = [{"role": "system", "content": system_prompt}]
+        with self._lock:
+            self.conversations[thread_id].append(message)
+            messages.extend(
+                {"role": msg["role"], "content": msg["content"]}
+                for msg in self.conversations[thread_id]
+            )
+        messages[-1]["content"] = [{"type": "text", "text": user_message}]
+        
+        return messages
     
     def clear_history(self, thread_id: str) -> None:
         """
@@ -135,8 +197,8 @@ class ConversationManager:
         Example:
             manager.clear_history("user_123")  # Removes all messages for user_123
         """
-        if thread_id in self.conversations:
-            del self.conversations[thread_id]
+        with self._lock:
+            self.conversations.pop(thread_id, None)
     
     def get_all_threads(self) -> List[str]:
         """
@@ -152,7 +214,8 @@ class ConversationManager:
                 history = manager.get_history(thread_id)
                 print(f"Thread {thread_id}: {len(history)} messages")
         """
-        return list(self.conversations.keys())
+        with self._lock:
+            return list(self.conversations.keys())
     
     def get_thread_count(self) -> int:
         """
@@ -0,0 +1,31 @@
+"""
+Streaming Module for AI Agent
+=============================
+
+Helpers for delivering streamed responses to the Lexia platform.
+This module keeps transport concerns out of the main processing logic.
+
+Features:
+- Coalescing of small OpenAI deltas into fewer Centrifugo publishes
+- Non-blocking Centrifugo publishing over pooled connections
+- Configurable time and size flush windows
+- Ordered delivery of buffered chunks
+
+Usage:
+    from streaming import CentrifugoPublisher, StreamBuffer
+    
+    # Publish buffered text through any async sender
+    buffer = StreamBuffer(send)
+    buffer.write("Hello")
+    buffer.write(", world!")
+    await buffer.close()
+    
+    # Publish deltas to Centrifugo without blocking the event loop
+    publisher = CentrifugoPublisher()
+    await publisher.send_delta(url, api_key, channel, uuid, thread_id, "Hello")
+"""
+
+from .centrifugo_publisher import CentrifugoPublisher
+from .stream_buffer import StreamBuffer
+
+__all__ = ['CentrifugoPublisher', 'StreamBuffer']
@@ -0,0 +1,118 @@
+"""
+Async Centrifugo Publisher
+==========================
+
+Publishes streaming deltas to Centrifugo through a shared, keep-alive
+httpx.AsyncClient. LexiaHandler.stream_chunk sends every delta with a blocking
+requests.post call, which opens a new connection each time and has to run in a
+worker thread. This publisher sends the same payload without blocking the
+event loop, and reuses pooled connections across chunks and requests.
+
+Features:
+- Same publish payload as Lexia's CentrifugoClient
+- Persistent connection pool shared by all requests
+- orjson serialization of payloads
+- Errors are logged, never raised, matching Lexia's client
+
+Example:
+    publisher = CentrifugoPublisher()
+    await publisher.send_delta(
+        data.stream_url, data.stream_token,
+        data.channel, data.response_uuid, data.thread_id,
+        "Hello"
+    )
+"""
+
+import logging
+from typing import Any, Dict, Optional
+
+import httpx
+import orjson
+
+logger = logging.getLogger(__name__)
+
+
+class CentrifugoPublisher:
+    """
+    Sends messages to Centrifugo's HTTP publish API over a pooled async client.
+    
+    Attributes:
+        client (httpx.AsyncClient): Shared HTTP client used for every publish
+        
+    Example:
+        publisher = CentrifugoPublisher(timeout=5.0)
+        await publisher.publish(stream_url, stream_token, "channel", {"delta": "Hi"})
+        await publisher.aclose()
+    """
+    
+    def __init__(self, client: Optional[httpx.AsyncClient] = None, timeout: float = 10.0):
+        """
+        Initialize the publisher.
+        
+        Args:
+            client: Optional preconfigured HTTP client. If None, a keep-alive client
+                   with HTTP/2 enabled is created.
+            timeout: Request timeout in seconds for the default client
+        """
+        self.client = client or httpx.AsyncClient(
+            http2=True,
+            timeout=timeout,
+            limits=httpx.Limits(max_keepalive_connections=100)
+        )
+    
+    async def publish(self, url: str, api_key: str, channel: str, data: Dict[str, Any]) -> None:
+        """
+        Publish data to a Centrifugo channel.
+        
+        Args:
+            url: Centrifugo server URL (the request's stream_url)
+            api_key: Centrifugo API key (the request's stream_token)
+            channel: Channel name to publish to
+            data: Message payload
+        """
+        headers = {
+            'X-API-Key': api_key,
+            'Authorization': f'apikey {api_key}',
+            'Content-Type': 'application/json',
+        }
+        payload = orjson.dumps({'channel': channel, 'data': data})
+        
+        try:
+            response = await self.client.post(f'{url}/api/publish', headers=headers, content=payload)
+            if response.status_code != 200:
+                logger.warning("Failed to send message to channel %s. Status: %s", channel, response.status_code)
+        except httpx.HTTPError as e:
+            logger.error("Error sending message to Centrifugo channel %s: %s", channel, e)
+    
+    async def send_delta(
+        self,
+        url: str,
+        api_key: str,
+        channel: str,
+        uuid: str,
+        thread_id: str,
+        delta: str
+    ) -> None:
+        """
+        Publish a streaming delta message.
+        
+        Args:
+            url: Centrifugo server URL
+            api_key: Centrifugo API key
+            channel: Channel name
+            uuid: Response UUID
+            thread_id: Thread ID
+            delta: Text delta to send
+        """
+        await self.publish(url, api_key, channel, {
+            'delta': delta,
+            'finished': False,
+            'uuid': uuid,
+            'thread_id': thread_id
+        })
+    
+    async def aclose(self) -> None:
+        """
+        Close the underlying HTTP client and its pooled connections.
+        """
+        await self.client.aclose()
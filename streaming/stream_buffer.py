@@ -0,0 +1,160 @@
+"""
+Stream Buffer for Response Streaming
+====================================
+
+Coalesces the many tiny deltas produced by a streaming OpenAI response into
+larger chunks before they are published to Lexia. Every publish is a separate
+HTTP request to Centrifugo, so sending one request per token wastes round trips
+without making the response feel any faster to the user.
+
+Features:
+- Time window flushing (default 20 ms, configurable via STREAM_COALESCE_MS)
+- Size threshold flushing for bursts of content
+- Strictly ordered delivery, even when flushes overlap
+- Final flush on close so no content is lost
+- Cancellation of pending publishes when a response fails
+
+Example:
+    async def send(text: str) -> None:
+        await asyncio.to_thread(lexia.stream_chunk, data, text)
+    
+    buffer = StreamBuffer(send)
+    async for chunk in stream:
+        buffer.write(chunk.choices[0].delta.content)
+    
+    # Flush whatever is left before completing the response
+    await buffer.close()
+"""
+
+import asyncio
+import os
+from typing import Awaitable, Callable, List, Optional, Set
+
+
+def _default_window() -> float:
+    """
+    Read the coalescing window from the environment.
+    
+    Returns:
+        Window length in seconds (STREAM_COALESCE_MS, default 20 ms)
+    """
+    return float(os.getenv("STREAM_COALESCE_MS", "20")) / 1000
+
+
+class StreamBuffer:
+    """
+    Buffers streamed text and publishes it in batches.
+    
+    Text written to the buffer is sent once the time window elapses or once
+    the buffered size reaches max_chars, whichever happens first. Flushes are
+    serialized so chunks always arrive in the order they were written.
+    
+    Attributes:
+        window (float): Seconds to wait before flushing buffered text
+        max_chars (int): Buffered size that triggers an immediate flush
+        
+    Example:
+        buffer = StreamBuffer(send, window=0.05, max_chars=64)
+        buffer.write("partial ")
+        buffer.write("response")
+        await buffer.close()
+    """
+    
+    def __init__(
+        self,
+        send: Callable[[str], Awaitable[None]],
+        window: Optional[float] = None,
+        max_chars: int = 32
+    ):
+        """
+        Initialize the stream buffer.
+        
+        Must be created from within a running event loop.
+        
+        Args:
+            send: Coroutine function that publishes one chunk of text
+            window: Seconds to wait before flushing. Defaults to STREAM_COALESCE_MS.
+            max_chars: Buffered size that triggers an immediate flush
+        """
+        self.window = _default_window() if window is None else window
+        self.max_chars = max_chars
+        self._send = send
+        self._parts: List[str] = []
+        self._size = 0
+        self._loop = asyncio.get_running_loop()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._lock = asyncio.Lock()
+        self._tasks: Set[asyncio.Task] = set()
+    
+    def write(self, text: str) -> None:
+        """
+        Add text to the buffer and schedule a flush.
+        
+        Args:
+            text: The text to publish
+        """
+        if not text:
+            return
+        
+        self._parts.append(text)
+        self._size += len(text)
+        
+        if self._size >= self.max_chars or self.window <= 0:
+            self._cancel_timer()
+            self._spawn_flush()
+        elif self._timer is None:
+            self._timer = self._loop.call_later(self.window, self._spawn_flush)
+    
+    async def flush(self) -> None:
+        """
+        Publish all buffered text immediately.
+        """
+        self._cancel_timer()
+        async with self._lock:
+            if not self._parts:
+                return
+            text = "".join(self._parts)
+            self._parts.clear()
+            self._size = 0
+            await self._send(text)
+    
+    async def close(self) -> None:
+        """
+        Flush remaining text and wait for all pending publishes to finish.
+        
+        Raises:
+            Exception: The first error raised by a pending publish
+        """
+        await self.flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+    
+    def cancel(self) -> None:
+        """
+        Drop buffered text and cancel pending publishes.
+        
+        Used when the response fails, so no chunks are sent after the error.
+        Does nothing once close() has finished.
+        """
+        self._cancel_timer()
+        self._parts.clear()
+        self._size = 0
+        for task in self._tasks:
+            task.cancel()
+    
+    def _spawn_flush(self) -> None:
+        """
+        Start a background flush task and keep a reference until it finishes.
+        """
+        self._timer = None
+        task = self._loop.create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    def _cancel_timer(self) -> None:
+        """
+        Cancel the pending time window flush, if any.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None